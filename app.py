@@ -3,25 +3,115 @@ WhatsApp Bot - Aplicación principal
 """
 
 import asyncio
+import time
 from contextlib import asynccontextmanager
 from datetime import datetime
+from urllib.parse import parse_qsl
 
-from fastapi import FastAPI, Request, Response, HTTPException
+import orjson
+from fastapi import FastAPI, Request, Response, HTTPException, BackgroundTasks
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import ORJSONResponse
+from sqlalchemy import text
 
-from src.settings import ENV, API_PORT, get_logger
-from src.db import init_db, get_db_session
-from src.handlers import process_message
+from src.settings import (
+    ENV, API_HOST, API_PORT, API_BACKLOG, API_WORKERS, MAX_INFLIGHT,
+    DUPLICATE_WINDOW_SECONDS, get_logger,
+)
+from src.db import init_db, warmup_db, get_db_session
+from src.handlers import process_message, is_menu_input
 from src.routes import router as api_router
+from src.services import whatsapp, llm, rag, message_log
+from src.services.idempotency import RecentKeys
 
 logger = get_logger(__name__)
 
+# Limitar mensajes procesandose en paralelo
+_semaphore = asyncio.Semaphore(MAX_INFLIGHT)
+
+# Health check cacheado (refrescado en background)
+HEALTH_REFRESH_SECONDS = 2
+HEALTH_MAX_AGE_SECONDS = 10
+_health_cache = {"body": None, "ts": 0.0}
+_HEALTH_STMT = text("SELECT 1")
+
+# Respuestas estáticas serializadas una sola vez
+_ROOT_BODY = orjson.dumps({"status": "running", "service": "whatsapp-bot", "version": "3.0.0"})
+
+# Consultas frecuentes para precalentar el índice RAG al arrancar
+_RAG_WARMUP_QUERIES = ("internet no funciona", "factura", "plan hogar")
+
+# Idempotencia: MessageSid ya recibidos (Twilio reintenta si el ACK tarda).
+# Es por proceso: con varios workers un reintento puede llegar a otro y no
+# detectarse aquí; ese caso lo cubre la verificación en BD de _register_inbound
+IDEMPOTENCY_TTL_SECONDS = 3600
+IDEMPOTENCY_MAX_SIZE = 10000
+_seen_messages = RecentKeys(IDEMPOTENCY_TTL_SECONDS, IDEMPOTENCY_MAX_SIZE)
+
+# Mismo texto libre del mismo teléfono en pocos segundos (doble envío del usuario).
+# Números, comandos y botones quedan fuera: repetir "1" es navegar, no duplicar
+_recent_texts = RecentKeys(DUPLICATE_WINDOW_SECONDS, IDEMPOTENCY_MAX_SIZE)
+
+
+async def _run(phone, body, message_sid):
+    """Procesar mensaje respetando el limite de concurrencia"""
+    async with _semaphore:
+        await process_message(phone, body, message_sid)
+
+
+def _check_db():
+    """Verificar conexión a la base de datos"""
+    db = get_db_session()
+    try:
+        db.execute(_HEALTH_STMT)
+    finally:
+        db.close()
+
+
+def _warm_rag():
+    """Cargar el índice RAG y precalentar la cache de búsquedas"""
+    try:
+        for query in _RAG_WARMUP_QUERIES:
+            rag.get_context_for_query(query)
+        logger.info("Índice RAG precalentado")
+    except Exception as e:
+        logger.warning(f"No se pudo precalentar el índice RAG: {e}")
+
+
+async def _health_refresher():
+    """Refrescar periódicamente el estado de salud"""
+    while True:
+        try:
+            await asyncio.to_thread(_check_db)
+            # Serializado aquí una vez por ciclo, no en cada probe
+            _health_cache["body"] = orjson.dumps({
+                "status": "healthy",
+                "database": "ok",
+                "timestamp": datetime.utcnow().isoformat(),
+            })
+            _health_cache["ts"] = time.monotonic()
+        except Exception as e:
+            logger.error(f"Health check falló: {e}")
+        await asyncio.sleep(HEALTH_REFRESH_SECONDS)
+
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Ciclo de vida de la aplicación"""
     logger.info(f"Iniciando aplicación en modo {ENV}")
     init_db()
+    warmup_db()
+    message_log.start()
+    health_task = asyncio.create_task(_health_refresher())
+    # Cargar el índice RAG sin bloquear el arranque
+    rag_task = asyncio.create_task(asyncio.to_thread(_warm_rag))
     logger.info("Aplicación lista")
     yield
+    health_task.cancel()
+    rag_task.cancel()
+    await message_log.stop()
+    await whatsapp.close()
+    await llm.close()
     logger.info("Aplicación detenida")
 
 
@@ -30,8 +120,12 @@ app = FastAPI(
     description="Bot de WhatsApp para soporte ISP 📶",
     version="1.0.0",
     lifespan=lifespan,
+    default_response_class=ORJSONResponse,
 )
 
+# Comprimir respuestas grandes (listados de la API); el webhook y /health quedan por debajo del umbral
+app.add_middleware(GZipMiddleware, minimum_size=1024, compresslevel=5)
+
 # Rutas API
 app.include_router(api_router, prefix="/api/v1", tags=["API"])
 
@@ -39,43 +133,45 @@ app.include_router(api_router, prefix="/api/v1", tags=["API"])
 @app.get("/")
 async def root():
     """Ruta principal"""
-    return {"status": "running", "service": "whatsapp-bot", "version": "3.0.0"}
+    return Response(content=_ROOT_BODY, media_type="application/json")
 
 
 @app.get("/health")
 async def health():
     """Health check"""
-    try:
-        from sqlalchemy import text
-        db = get_db_session()
-        db.execute(text("SELECT 1"))
-        db.close()
-        
-        return {
-            "status": "healthy",
-            "database": "ok",
-            "timestamp": datetime.utcnow().isoformat(),
-        }
-    except Exception as e:
-        logger.error(f"Health check falló: {e}")
+    body = _health_cache["body"]
+    if body is None or time.monotonic() - _health_cache["ts"] > HEALTH_MAX_AGE_SECONDS:
         raise HTTPException(status_code=503, detail="Unhealthy")
+    return Response(content=body, media_type="application/json")
 
 
 @app.post("/webhook/twilio")
-async def twilio_webhook(request: Request):
+async def twilio_webhook(request: Request, background_tasks: BackgroundTasks):
     """Webhook para recibir mensajes de Twilio"""
     try:
-        form_data = await request.form()
-        
-        phone = form_data.get("From", "").replace("whatsapp:", "")
+        # Twilio envía application/x-www-form-urlencoded
+        raw = await request.body()
+        form_data = dict(parse_qsl(raw.decode(), keep_blank_values=True))
+
+        phone = form_data.get("From", "")
+        if phone.startswith("whatsapp:"):
+            phone = phone[9:]
         body = form_data.get("Body", "")
         message_sid = form_data.get("MessageSid", "")
 
-        logger.info(f"Mensaje recibido de {phone}: {body[:50]}...")
+        logger.info("Mensaje recibido de %s: %.50s...", phone, body)
+
+        if message_sid and _seen_messages.seen(message_sid):
+            logger.info("Mensaje duplicado ignorado: %s", message_sid)
+            return Response(content="", status_code=200)
+
+        if body and phone and not is_menu_input(body) and _recent_texts.seen((phone, body)):
+            logger.info("Mensaje repetido de %s en menos de %ss, ignorado", phone, DUPLICATE_WINDOW_SECONDS)
+            return Response(content="", status_code=200)
 
         if body and phone:
-            # Procesar mensaje en background
-            asyncio.create_task(process_message(phone, body, message_sid))
+            # Procesar mensaje en background (despues de enviar la respuesta)
+            background_tasks.add_task(_run, phone, body, message_sid)
 
         return Response(content="", status_code=200)
     
@@ -86,4 +182,26 @@ async def twilio_webhook(request: Request):
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=API_PORT)
+
+    if ENV == "production":
+        # Un proceso por core; access log desactivado (escritura síncrona por request)
+        uvicorn.run(
+            "app:app",
+            host=API_HOST,
+            port=API_PORT,
+            workers=API_WORKERS,
+            backlog=API_BACKLOG,
+            loop="uvloop",
+            http="httptools",
+            log_config=None,
+            access_log=False,
+        )
+    else:
+        uvicorn.run(
+            app,
+            host=API_HOST,
+            port=API_PORT,
+            backlog=API_BACKLOG,
+            loop="uvloop",
+            http="httptools",
+        )
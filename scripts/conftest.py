@@ -0,0 +1,65 @@
+"""
+Fixtures compartidas por los tests
+"""
+
+import pytest
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+from src.models import Base
+
+
+@pytest.fixture(scope="session")
+def db_engine():
+    """Engine SQLite en memoria compartido; el esquema se crea una sola vez"""
+    engine = create_engine(
+        "sqlite://",
+        connect_args={"check_same_thread": False},
+        poolclass=StaticPool,
+        echo=False,
+    )
+
+    @event.listens_for(engine, "connect")
+    def _configure_connection(dbapi_connection, connection_record):
+        # pysqlite no emite BEGIN por su cuenta: necesario para que los SAVEPOINT
+        # queden dentro de la transaccion externa que se revierte en cada test
+        dbapi_connection.isolation_level = None
+
+        # BD efimera: sin fsync ni journal en disco
+        cursor = dbapi_connection.cursor()
+        cursor.executescript(
+            "PRAGMA journal_mode=MEMORY;"
+            "PRAGMA synchronous=OFF;"
+            "PRAGMA temp_store=MEMORY;"
+        )
+        cursor.close()
+
+    @event.listens_for(engine, "begin")
+    def _emit_begin(conn):
+        conn.exec_driver_sql("BEGIN")
+
+    Base.metadata.create_all(bind=engine)
+    yield engine
+    engine.dispose()
+
+
+@pytest.fixture(scope="session")
+def session_factory():
+    """Fábrica de sesiones construida una sola vez"""
+    return sessionmaker(expire_on_commit=False, join_transaction_mode="create_savepoint")
+
+
+@pytest.fixture
+def db_session(db_engine, session_factory):
+    """Sesión de prueba dentro de una transacción que se revierte al terminar"""
+    connection = db_engine.connect()
+    transaction = connection.begin()
+    session = session_factory(bind=connection)
+
+    yield session
+
+    session.close()
+    transaction.rollback()
+    connection.close()
@@ -3,9 +3,6 @@ Reset Database Script - DROPS AND RECREATES TABLES
 """
 
 import sys
-from pathlib import Path
-
-sys.path.insert(0, str(Path(__file__).parent.parent))
 
 from src.settings import get_logger
 from src.db import engine, init_db
@@ -3,39 +3,18 @@ Tests básicos del ciclo de conversación
 """
 
 import pytest
-import sys
-from pathlib import Path
 
-sys.path.insert(0, str(Path(__file__).parent.parent))
-
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
-
-from src.models import Base, User, Conversation, Message
+from src.models import User, Conversation, Message
 from src.services.session import get_or_create_user, get_or_create_conversation, update_conversation_state
 from src.settings import flows_config
 
-
-# =============================================================================
-# Fixtures
-# =============================================================================
-
-@pytest.fixture(scope="module")
-def db_engine():
-    """Crear engine de prueba con SQLite en memoria"""
-    engine = create_engine("sqlite:///:memory:", echo=False)
-    Base.metadata.create_all(bind=engine)
-    return engine
-
-
-@pytest.fixture
-def db_session(db_engine):
-    """Crear sesión de prueba"""
-    Session = sessionmaker(bind=db_engine)
-    session = Session()
-    yield session
-    session.rollback()
-    session.close()
+_FLOWS = flows_config["flows"]
+_FLOW_IDS = frozenset(_FLOWS)
+_BUTTON_CASES = tuple(
+    (flow_id, btn.get("id"), btn.get("title"))
+    for flow_id, flow_data in _FLOWS.items()
+    for btn in flow_data.get("buttons", [])
+)
 
 
 # =============================================================================
@@ -117,7 +96,7 @@ def test_flows_config_loaded():
 
 def test_welcome_flow_has_buttons():
     """Verificar que welcome tiene botones"""
-    welcome = flows_config["flows"]["welcome"]
+    welcome = _FLOWS["welcome"]
     
     assert "buttons" in welcome
     assert len(welcome["buttons"]) >= 3
@@ -125,44 +104,35 @@ def test_welcome_flow_has_buttons():
 
 def test_support_has_4_levels():
     """Verificar que soporte tiene 4 niveles"""
-    flows = flows_config["flows"]
-    
-    assert "support_lvl1" in flows
-    assert "support_lvl2_conn" in flows
-    assert "support_lvl3_no_service" in flows
-    assert "support_lvl4_recent" in flows
+    assert "support_lvl1" in _FLOW_IDS
+    assert "support_lvl2_conn" in _FLOW_IDS
+    assert "support_lvl3_no_service" in _FLOW_IDS
+    assert "support_lvl4_recent" in _FLOW_IDS
 
 
 def test_plans_has_4_levels():
     """Verificar que planes tiene 4 niveles"""
-    flows = flows_config["flows"]
-    
-    assert "plans_lvl1" in flows
-    assert "plans_lvl2_home" in flows
-    assert "plans_lvl3_basic" in flows
-    assert "plans_lvl4_contract" in flows
+    assert "plans_lvl1" in _FLOW_IDS
+    assert "plans_lvl2_home" in _FLOW_IDS
+    assert "plans_lvl3_basic" in _FLOW_IDS
+    assert "plans_lvl4_contract" in _FLOW_IDS
 
 
 def test_billing_has_4_levels():
     """Verificar que facturación tiene 4 niveles"""
-    flows = flows_config["flows"]
-    
-    assert "billing_lvl1" in flows
-    assert "billing_lvl2_pay" in flows
-    assert "billing_lvl3_transfer" in flows
-    assert "billing_lvl4_yes" in flows
+    assert "billing_lvl1" in _FLOW_IDS
+    assert "billing_lvl2_pay" in _FLOW_IDS
+    assert "billing_lvl3_transfer" in _FLOW_IDS
+    assert "billing_lvl4_yes" in _FLOW_IDS
 
 
 # =============================================================================
 # Tests de Navegación de Flujos
 # =============================================================================
 
-def test_flow_buttons_have_valid_targets():
-    """Verificar que los botones apuntan a flujos existentes"""
-    flows = flows_config["flows"]
-    
-    for flow_id, flow_data in flows.items():
-        buttons = flow_data.get("buttons", [])
-        for btn in buttons:
-            target_id = btn.get("id")
-            assert target_id in flows, f"Botón '{btn.get('title')}' en '{flow_id}' apunta a flujo inexistente: {target_id}"
+@pytest.mark.parametrize(
+    "flow_id,target_id,title", _BUTTON_CASES, ids=[f"{fid}->{tid}" for fid, tid, _ in _BUTTON_CASES]
+)
+def test_flow_buttons_have_valid_targets(flow_id, target_id, title):
+    """Verificar que cada botón apunta a un flujo existente"""
+    assert target_id in _FLOW_IDS, f"Botón '{title}' en '{flow_id}' apunta a flujo inexistente: {target_id}"
@@ -2,28 +2,20 @@
 Tests minimos para validar el ciclo de conversacion y flujos
 """
 import pytest
-import sys
-import os
 
-sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
-
-from src.models import Base, User, Conversation
+from src.handlers import _save_message
+from src.models import User, Conversation, Message
+from src.services import session as session_service
 from src.services.session import get_or_create_user, get_or_create_conversation, update_conversation_state
 from src.settings import flows_config
 
-
-# Setup: base de datos en memoria para tests
-@pytest.fixture
-def db_session():
-    engine = create_engine("sqlite:///:memory:")
-    Base.metadata.create_all(engine)
-    Session = sessionmaker(bind=engine)
-    session = Session()
-    yield session
-    session.close()
+_FLOWS = flows_config["flows"]
+_FLOW_IDS = frozenset(_FLOWS)
+_BUTTON_CASES = tuple(
+    (flow_id, btn.get("id"), btn.get("title"))
+    for flow_id, flow_data in _FLOWS.items()
+    for btn in flow_data.get("buttons", [])
+)
 
 
 # Tests de usuarios
@@ -40,6 +32,22 @@ def test_get_existing_user(db_session):
     assert user.phone == "+1234567890"
 
 
+def test_rolled_back_user_id_is_not_cached(db_session):
+    get_or_create_user("+570000000001", db_session, commit=False)
+    db_session.rollback()
+    assert "+570000000001" not in session_service._user_ids
+
+
+def test_flushed_ids_are_cached_after_commit(db_session):
+    phone = "+570000000002"
+    user, _ = get_or_create_user(phone, db_session, commit=False)
+    conv = get_or_create_conversation(phone, db_session, commit=False, user_id=user.id)
+    assert phone not in session_service._user_ids
+    db_session.commit()
+    assert session_service._user_ids[phone][0] == user.id
+    assert session_service._conversation_ids[phone] == conv.id
+
+
 # Tests de conversaciones
 def test_create_new_conversation(db_session):
     get_or_create_user("+1234567890", db_session)
@@ -48,6 +56,38 @@ def test_create_new_conversation(db_session):
     assert conv.phone == "+1234567890"
 
 
+def test_reuses_active_conversation(db_session):
+    get_or_create_user("+1234567890", db_session)
+    conv = get_or_create_conversation("+1234567890", db_session)
+    assert get_or_create_conversation("+1234567890", db_session).id == conv.id
+
+
+def test_closed_conversation_is_not_reused(db_session):
+    get_or_create_user("+1234567890", db_session)
+    conv = get_or_create_conversation("+1234567890", db_session)
+    conv.status = "closed"
+    db_session.commit()
+    new_conv = get_or_create_conversation("+1234567890", db_session)
+    assert new_conv.id != conv.id
+    assert new_conv.status == "active"
+
+
+def test_conversation_ignores_user_id_of_another_phone(db_session):
+    other, _ = get_or_create_user("+570000000003", db_session)
+    user, _ = get_or_create_user("+570000000004", db_session)
+    conv = get_or_create_conversation("+570000000004", db_session, user_id=other.id)
+    assert conv.user_id == user.id
+    assert other.total_conversations == 0
+
+
+def test_consecutive_bot_messages_get_distinct_ids(db_session):
+    get_or_create_user("+1234567890", db_session)
+    conv = get_or_create_conversation("+1234567890", db_session)
+    _save_message(conv, "bot", "uno", None, db_session)
+    _save_message(conv, "bot", "dos", None, db_session)
+    assert db_session.query(Message).filter(Message.conversation_id == conv.id).count() == 2
+
+
 def test_update_conversation_state(db_session):
     get_or_create_user("+1234567890", db_session)
     conv = get_or_create_conversation("+1234567890", db_session)
@@ -64,45 +104,35 @@ def test_flows_config_loaded():
 
 
 def test_welcome_flow_has_buttons():
-    welcome = flows_config["flows"]["welcome"]
+    welcome = _FLOWS["welcome"]
     assert "buttons" in welcome
     assert len(welcome["buttons"]) >= 3
 
 
 def test_support_has_4_levels():
-    flows = flows_config["flows"]
-    assert "support_lvl1" in flows
-    assert "support_lvl2_conn" in flows
-    assert "support_lvl3_no_service" in flows
-    assert "support_lvl4_recent" in flows
+    assert "support_lvl1" in _FLOW_IDS
+    assert "support_lvl2_conn" in _FLOW_IDS
+    assert "support_lvl3_no_service" in _FLOW_IDS
+    assert "support_lvl4_recent" in _FLOW_IDS
 
 
 def test_plans_has_4_levels():
-    flows = flows_config["flows"]
-    assert "plans_lvl1" in flows
-    assert "plans_lvl2_home" in flows
-    assert "plans_lvl3_basic" in flows
-    assert "plans_lvl4_contract" in flows
+    assert "plans_lvl1" in _FLOW_IDS
+    assert "plans_lvl2_home" in _FLOW_IDS
+    assert "plans_lvl3_basic" in _FLOW_IDS
+    assert "plans_lvl4_contract" in _FLOW_IDS
 
 
 def test_billing_has_4_levels():
-    flows = flows_config["flows"]
-    assert "billing_lvl1" in flows
-    assert "billing_lvl2_pay" in flows
-    assert "billing_lvl3_transfer" in flows
-    assert "billing_lvl4_yes" in flows
-
-
-def test_flow_buttons_have_valid_targets():
-    """Verificar que todos los botones apuntan a flujos existentes"""
-    flows = flows_config["flows"]
-    missing = []
-    
-    for flow_id, flow_data in flows.items():
-        buttons = flow_data.get("buttons", [])
-        for btn in buttons:
-            target_id = btn.get("id")
-            if target_id and target_id not in flows:
-                missing.append(f"{flow_id} -> {target_id}")
-    
-    assert len(missing) == 0, f"Botones con targets invalidos: {missing}"
+    assert "billing_lvl1" in _FLOW_IDS
+    assert "billing_lvl2_pay" in _FLOW_IDS
+    assert "billing_lvl3_transfer" in _FLOW_IDS
+    assert "billing_lvl4_yes" in _FLOW_IDS
+
+
+@pytest.mark.parametrize(
+    "flow_id,target_id,title", _BUTTON_CASES, ids=[f"{fid}->{tid}" for fid, tid, _ in _BUTTON_CASES]
+)
+def test_flow_buttons_have_valid_targets(flow_id, target_id, title):
+    """Verificar que cada boton apunta a un flujo existente"""
+    assert not target_id or target_id in _FLOW_IDS, f"Boton invalido: {flow_id} -> {target_id}"
@@ -0,0 +1,87 @@
+"""
+Tests de idempotencia y registro de actividad reciente
+"""
+import time
+
+import pytest
+
+from src.handlers import is_menu_input
+from src.services import session as session_service
+from src.services.session import LAST_SEEN_RESOLUTION_SECONDS, get_or_create_user, touch_user
+from src.services.idempotency import RecentKeys
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Reloj monotónico controlado por el test"""
+    now = [1000.0]
+    monkeypatch.setattr(time, "monotonic", lambda: now[0])
+    return now
+
+
+# Tests de RecentKeys
+def test_first_sighting_is_not_seen(clock):
+    keys = RecentKeys(ttl_seconds=10, max_size=10)
+    assert keys.seen("SM1") is False
+    assert keys.seen("SM1") is True
+    assert keys.seen("SM2") is False
+
+
+def test_key_expires_after_ttl(clock):
+    keys = RecentKeys(ttl_seconds=10, max_size=10)
+    keys.seen("SM1")
+    clock[0] += 9
+    assert keys.seen("SM1") is True
+    clock[0] += 2
+    assert keys.seen("SM1") is False
+
+
+def test_oldest_key_is_evicted_at_max_size(clock):
+    keys = RecentKeys(ttl_seconds=60, max_size=2)
+    keys.seen("SM1")
+    keys.seen("SM2")
+    keys.seen("SM3")
+    assert keys.seen("SM3") is True
+    assert keys.seen("SM1") is False
+
+
+def test_full_map_still_recognizes_oldest_key(clock):
+    keys = RecentKeys(ttl_seconds=60, max_size=2)
+    keys.seen("SM1")
+    keys.seen("SM2")
+    assert keys.seen("SM1") is True
+    assert keys.seen("SM2") is True
+
+
+# Tests de touch_user
+def test_touch_user_skips_db_within_resolution(db_session, clock, monkeypatch):
+    user, _ = get_or_create_user("+570000000200", db_session)
+    calls = []
+    monkeypatch.setattr(
+        session_service, "get_or_create_user",
+        lambda *args, **kwargs: calls.append(args) or get_or_create_user(*args, **kwargs),
+    )
+
+    clock[0] += LAST_SEEN_RESOLUTION_SECONDS - 1
+    assert touch_user("+570000000200", db_session) == user.id
+    assert calls == []
+
+
+def test_touch_user_writes_last_seen_after_resolution(db_session, clock):
+    user, _ = get_or_create_user("+570000000201", db_session)
+    first_seen = user.last_seen
+
+    clock[0] += LAST_SEEN_RESOLUTION_SECONDS + 1
+    time.sleep(0.001)
+    assert touch_user("+570000000201", db_session) == user.id
+    assert user.last_seen > first_seen
+
+
+# Tests de entradas de menú (fuera de la ventana de duplicados)
+@pytest.mark.parametrize("text", ["1", " 2 ", "Menu", "salir"])
+def test_menu_inputs_are_not_deduplicated(text):
+    assert is_menu_input(text) is True
+
+
+def test_free_text_is_deduplicated():
+    assert is_menu_input("mi internet no funciona") is False
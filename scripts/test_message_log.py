@@ -0,0 +1,125 @@
+"""
+Tests del registro diferido de mensajes
+"""
+import asyncio
+from datetime import datetime
+
+import pytest
+
+from src.models import Message
+from src.services import message_log
+from src.services.session import get_or_create_user, get_or_create_conversation
+
+
+@pytest.fixture
+def conversation(db_session, session_factory, monkeypatch):
+    """Conversación de prueba; el worker escribe sobre la misma conexión del test"""
+    monkeypatch.setattr(message_log, "get_db_session", lambda: session_factory(bind=db_session.bind))
+    get_or_create_user("+570000000100", db_session)
+    return get_or_create_conversation("+570000000100", db_session)
+
+
+def _row(conversation, msg_id):
+    return {
+        "id": msg_id,
+        "conversation_id": conversation.id,
+        "sender": "bot",
+        "direction": "outbound",
+        "message_type": "text",
+        "content": f"mensaje {msg_id}",
+        "created_at": datetime.utcnow(),
+    }
+
+
+def _saved_ids(db_session, conversation):
+    rows = db_session.query(Message.id).filter(Message.conversation_id == conversation.id)
+    return {msg_id for (msg_id,) in rows}
+
+
+def test_enqueue_without_worker_returns_false(conversation):
+    assert message_log.enqueue(_row(conversation, "log_sin_worker")) is False
+
+
+def test_stop_writes_every_queued_row(db_session, conversation):
+    ids = [f"log_{i}" for i in range(message_log.BATCH_SIZE + 6)]
+
+    async def scenario():
+        message_log.start()
+        assert all(message_log.enqueue(_row(conversation, msg_id)) for msg_id in ids)
+        await message_log.stop()
+
+    asyncio.run(scenario())
+    assert _saved_ids(db_session, conversation) == set(ids)
+
+
+def test_rows_within_window_share_one_batch(conversation, monkeypatch):
+    batches = []
+    write_batch = message_log._write_batch
+    monkeypatch.setattr(message_log, "_write_batch", lambda rows: batches.append(len(rows)) or write_batch(rows))
+
+    async def scenario():
+        message_log.start()
+        for i in range(3):
+            message_log.enqueue(_row(conversation, f"log_ventana_{i}"))
+        await message_log.stop()
+
+    asyncio.run(scenario())
+    assert batches == [3]
+
+
+def test_full_queue_falls_back_to_sync(conversation, monkeypatch):
+    monkeypatch.setattr(message_log, "QUEUE_MAX_SIZE", 1)
+
+    async def scenario():
+        message_log.start()
+        first = message_log.enqueue(_row(conversation, "log_lleno_1"))
+        second = message_log.enqueue(_row(conversation, "log_lleno_2"))
+        await message_log.stop()
+        return first, second
+
+    assert asyncio.run(scenario()) == (True, False)
+
+
+def test_failed_row_does_not_drop_batch(db_session, conversation):
+    message_log._write_batch([_row(conversation, "log_repetido")])
+    message_log._write_batch([
+        _row(conversation, "log_ok_1"),
+        _row(conversation, "log_repetido"),
+        _row(conversation, "log_ok_2"),
+    ])
+    assert _saved_ids(db_session, conversation) == {"log_repetido", "log_ok_1", "log_ok_2"}
+
+
+def test_worker_survives_failed_batch(db_session, session_factory, conversation, monkeypatch):
+    calls = []
+
+    def flaky_session():
+        calls.append(1)
+        if len(calls) == 1:
+            raise RuntimeError("BD caída")
+        return session_factory(bind=db_session.bind)
+
+    monkeypatch.setattr(message_log, "get_db_session", flaky_session)
+
+    async def scenario():
+        message_log.start()
+        message_log.enqueue(_row(conversation, "log_perdido"))
+        await asyncio.sleep(message_log.BATCH_WINDOW_SECONDS * 2)
+        assert message_log.enqueue(_row(conversation, "log_despues")) is True
+        await asyncio.wait_for(message_log.stop(), 5)
+
+    asyncio.run(scenario())
+    assert _saved_ids(db_session, conversation) == {"log_despues"}
+
+
+def test_stop_returns_when_worker_is_dead(conversation, monkeypatch):
+    monkeypatch.setattr(message_log, "STOP_TIMEOUT_SECONDS", 0.1)
+
+    async def scenario():
+        message_log.start()
+        message_log._worker.cancel()
+        await asyncio.sleep(0)
+        message_log._queue.put_nowait(_row(conversation, "log_huerfano"))
+        await asyncio.wait_for(message_log.stop(), 5)
+
+    asyncio.run(scenario())
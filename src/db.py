@@ -1,25 +1,49 @@
 """
-Conexión a base de datos SQLite
+Conexión a base de datos (SQLite o PostgreSQL)
 """
 
 import os
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, inspect, text
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
 
-from .settings import DATABASE_URL, DEBUG, get_logger
+from .settings import (
+    ENV, DEBUG, DATABASE_URL, DB_POOL_SIZE, DB_MAX_OVERFLOW,
+    DB_POOL_RECYCLE, DB_POOL_TIMEOUT, DB_STATEMENT_TIMEOUT_MS, get_logger,
+)
 
 logger = get_logger(__name__)
 
 # Crear directorio data si no existe
 os.makedirs("./data", exist_ok=True)
 
-# Crear engine de SQLite
+# Opciones del engine según el backend
+if DATABASE_URL.startswith("sqlite"):
+    _engine_options = {"connect_args": {"check_same_thread": False}}
+else:
+    _engine_options = {
+        "pool_pre_ping": True,
+        "pool_size": DB_POOL_SIZE,
+        "max_overflow": DB_MAX_OVERFLOW,
+        "pool_recycle": DB_POOL_RECYCLE,
+        "pool_timeout": DB_POOL_TIMEOUT,
+    }
+    if DATABASE_URL.startswith("postgresql"):
+        # Acotar consultas lentas en el servidor
+        _engine_options["connect_args"] = {
+            "options": f"-c statement_timeout={DB_STATEMENT_TIMEOUT_MS}"
+        }
+
+# Crear engine (el log de SQL solo en desarrollo con DEBUG activo)
 engine = create_engine(
     DATABASE_URL,
-    connect_args={"check_same_thread": False},
-    echo=DEBUG,
+    echo=ENV == "development" and DEBUG,
+    **_engine_options,
 )
 
+# Clave del advisory lock que serializa init_db entre workers
+_INIT_LOCK_KEY = 0x6277_6462  # "bwdb"
+
 # Crear sesión
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
@@ -43,7 +67,34 @@ def init_db():
     from .models import Base
     
     try:
-        Base.metadata.create_all(bind=engine, checkfirst=True)
+        with engine.begin() as conn:
+            # PostgreSQL: un solo worker ejecuta el DDL, el resto espera y ve las tablas creadas
+            if conn.dialect.name == "postgresql":
+                conn.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": _INIT_LOCK_KEY})
+
+            # Una sola consulta al catálogo en lugar de una por tabla
+            existing = set(inspect(conn).get_table_names())
+            missing = [t for t in Base.metadata.sorted_tables if t.name not in existing]
+            if missing:
+                Base.metadata.create_all(bind=conn, tables=missing, checkfirst=False)
         logger.info(f"Base de datos inicializada: {DATABASE_URL}")
     except Exception as e:
         logger.error(f"Error inicializando base de datos: {e}")
+
+
+def warmup_db():
+    """Abrir las conexiones del pool antes de recibir tráfico"""
+    size = engine.pool.size() if isinstance(engine.pool, QueuePool) else 1
+    connections = []
+
+    try:
+        for _ in range(size):
+            conn = engine.connect()
+            conn.execute(text("SELECT 1"))
+            connections.append(conn)
+        logger.info(f"Pool de base de datos precalentado ({size} conexiones)")
+    except Exception as e:
+        logger.error(f"Error precalentando pool de base de datos: {e}")
+    finally:
+        for conn in connections:
+            conn.close()
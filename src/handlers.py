@@ -2,12 +2,15 @@
 Manejador de mensajes - Navegacion dinamica de flujos con inteligencia local
 """
 
+import asyncio
+import time
+from collections import deque
 from datetime import datetime
 
 from .settings import business_config, flows_config, sanitize_input, get_logger
 from .db import get_db_session
 from .models import Message
-from .services import whatsapp, session, llm
+from .services import whatsapp, session, llm, message_log
 from .services.intelligence import (
     fuzzy_match_option,
     check_keyword_trigger,
@@ -24,28 +27,90 @@ from .services.intelligence import (
 
 logger = get_logger(__name__)
 
+# Secciones de configuración (estáticas durante la vida del proceso)
+_FLOWS = flows_config.get("flows", {})
+_FALLBACK_TEXT = flows_config.get("defaults", {}).get("fallback", "No entendi su respuesta.")
+_BUSINESS_NAME = business_config.get("business", {}).get("name", "nuestra empresa")
+
+
+def _index_buttons(buttons):
+    """Precalcular ids y titulos (originales y en minusculas) de los botones de un flujo"""
+    return {
+        "ids": [btn.get("id") for btn in buttons],
+        "titles": [btn.get("title", "") for btn in buttons],
+        "lowered": [(btn.get("title", "").lower(), btn.get("id")) for btn in buttons],
+    }
+
+
+# Botones indexados por flujo (se construye una sola vez al importar)
+_BUTTON_INDEX = {flow_id: _index_buttons(flow.get("buttons", [])) for flow_id, flow in _FLOWS.items()}
+
+# Textos de cada flujo con el nombre del negocio ya sustituido
+_FLOW_TEXTS = {
+    flow_id: flow.get("text", "").replace("{business_name}", _BUSINESS_NAME)
+    for flow_id, flow in _FLOWS.items()
+}
+
+# Mensaje final de cada flujo (menu numerado ya armado si tiene botones)
+_FLOW_MESSAGES = {
+    flow_id: (
+        whatsapp.format_menu(_FLOW_TEXTS[flow_id], flow["buttons"], flow.get("header", ""))
+        if flow.get("buttons") else _FLOW_TEXTS[flow_id]
+    )
+    for flow_id, flow in _FLOWS.items()
+}
+
+# Bienvenida personalizada ya armada; por mensaje solo se sustituye el nickname
+_NICKNAME_SLOT = "\x00"
+
+
+def _build_welcome_template():
+    """Precalcular el menu de bienvenida con un hueco para el nickname"""
+    flow = _FLOWS.get("welcome", {})
+    text = _FLOW_TEXTS.get("welcome", "").replace("Bienvenido", f"Hola {_NICKNAME_SLOT}! Bienvenido")
+    if flow.get("buttons"):
+        return whatsapp.format_menu(text, flow["buttons"], flow.get("header", ""))
+    return text
+
+
+_WELCOME_TEMPLATE = _build_welcome_template()
+
+# Mensajes del historial que se guardan en el contexto
+CHAT_HISTORY_SIZE = 6
+
+# Saludos que se personalizan con el nickname (en minusculas y capitalizado)
+_GREETINGS = tuple((g, g.capitalize()) for g in ("hola", "bienvenido", "gracias"))
+
 # Comandos para volver al menu (configurables desde settings.json)
-EXIT_COMMANDS = business_config.get("bot", {}).get(
-    "exit_commands", ["salir", "cancelar", "menu", "inicio", "0", "volver", "atras"]
+EXIT_COMMANDS = frozenset(
+    cmd.lower().strip()
+    for cmd in business_config.get("bot", {}).get(
+        "exit_commands", ["salir", "cancelar", "menu", "inicio", "0", "volver", "atras"]
+    )
+)
+
+# Textos que navegan los menús: comandos de salida y titulos de botones
+_MENU_INPUTS = EXIT_COMMANDS | frozenset(
+    title for index in _BUTTON_INDEX.values() for title, _ in index["lowered"]
 )
 
 
+def is_menu_input(message):
+    """True si el texto navega menús (número, comando o botón): repetirlo es legítimo"""
+    text = message.lower().strip()
+    return text.isdigit() or text in _MENU_INPUTS
+
+
 async def process_message(phone, message, external_id=None):
     """Procesar mensaje entrante de WhatsApp"""
     message = sanitize_input(message)
     db = get_db_session()
 
     try:
-        user, _ = session.get_or_create_user(phone, db)
-        conversation = session.get_or_create_conversation(phone, db)
-
-        # Verificar duplicado
-        if external_id:
-            existing = db.query(Message).filter(Message.id == external_id).first()
-            if existing:
-                return
-
-        _save_message(conversation, "user", message, external_id, db)
+        # El acceso a BD es síncrono: ejecutarlo fuera del event loop
+        conversation = await asyncio.to_thread(_register_inbound, phone, message, external_id, db)
+        if conversation is None:
+            return
 
         # Obtener contexto
         context = conversation.context or {}
@@ -58,10 +123,13 @@ async def process_message(phone, message, external_id=None):
             if nickname:
                 logger.info(f"Nickname extraido: {nickname}")
                 context["nickname"] = nickname
-                session.update_conversation_state(conversation, conversation.state, db, context)
+                await asyncio.to_thread(_save_nickname, conversation, db, context)
         
+        # Normalizar una sola vez para comandos y botones
+        message_lower = message.lower().strip()
+
         # 1. Verificar si quiere salir al menu
-        if message.lower().strip() in EXIT_COMMANDS:
+        if message_lower in EXIT_COMMANDS:
             await _go_to_flow(phone, "welcome", conversation, db, nickname)
             return
 
@@ -72,17 +140,16 @@ async def process_message(phone, message, external_id=None):
                 await _go_to_flow(phone, "welcome", conversation, db, nickname)
             else:
                 response = _personalize_response(trigger_response, nickname)
-                _save_message(conversation, "bot", response, None, db)
-                await whatsapp.send_message(phone, response)
+                _save_message(conversation, "bot", response, None, db, commit=False)
+                await _alongside_db(whatsapp.send_message(phone, response), db.commit)
             return
 
-        # 3. Obtener el flujo actual
-        flow_data = flows_config.get("flows", {}).get(current_flow, {})
-        buttons = flow_data.get("buttons", [])
+        # 3. Obtener los botones del flujo actual
+        buttons = _BUTTON_INDEX.get(current_flow)
 
         # 4. Si el flujo actual tiene botones, intentar navegar
-        if buttons:
-            next_flow = _get_next_flow_from_input(message, buttons)
+        if buttons and buttons["ids"]:
+            next_flow = _get_next_flow_from_input(message_lower, buttons)
             
             if next_flow:
                 await _go_to_flow(phone, next_flow, conversation, db, nickname)
@@ -97,8 +164,7 @@ async def process_message(phone, message, external_id=None):
         if current_flow == "welcome":
             await _go_to_flow(phone, "welcome", conversation, db, nickname)
         else:
-            fallback = flows_config.get("defaults", {}).get("fallback", "No entendi su respuesta.")
-            fallback = _personalize_response(fallback, nickname)
+            fallback = _personalize_response(_FALLBACK_TEXT, nickname)
             await whatsapp.send_message(phone, fallback)
             await _show_flow(phone, current_flow, nickname)
 
@@ -108,31 +174,53 @@ async def process_message(phone, message, external_id=None):
         db.close()
 
 
+def _register_inbound(phone, message, external_id, db):
+    """Registrar usuario, conversación y mensaje entrante (None si es duplicado)"""
+    # Verificar duplicado antes de tocar usuario/conversacion
+    if external_id:
+        existing = db.query(Message.id).filter(Message.id == external_id).first()
+        if existing:
+            return None
+
+    # Usuario, conversación y mensaje entrante en una sola transacción
+    user_id = session.touch_user(phone, db, commit=False)
+    conversation = session.get_or_create_conversation(phone, db, commit=False, user_id=user_id)
+    _save_message(conversation, "user", message, external_id, db, commit=False)
+    db.commit()
+
+    # Recargar aquí lo que expiró el commit, no en el event loop
+    db.refresh(conversation)
+    return conversation
+
+
+def _save_nickname(conversation, db, context):
+    """Guardar el nickname y recargar aquí lo que expiró el commit, no en el event loop"""
+    session.update_conversation_state(conversation, conversation.state, db, context)
+    db.refresh(conversation)
+
+
 def _get_next_flow_from_input(message, buttons):
-    """Determinar el siguiente flujo basado en el input del usuario"""
-    message = message.strip().lower()
+    """Determinar el siguiente flujo basado en el input del usuario (ya en minusculas y sin espacios)"""
+    ids = buttons["ids"]
     
     # 1. Intentar por numero (1, 2, 3...)
     if message.isdigit():
         index = int(message) - 1
-        if 0 <= index < len(buttons):
-            return buttons[index].get("id")
+        if 0 <= index < len(ids):
+            return ids[index]
     
     # 2. Intentar por texto exacto o parcial
-    for btn in buttons:
-        title = btn.get("title", "").lower()
+    for title, btn_id in buttons["lowered"]:
         if message in title or title in message:
-            return btn.get("id")
+            return btn_id
     
     # 3. Fuzzy matching para typos
-    titles = [btn.get("title", "") for btn in buttons]
+    titles = buttons["titles"]
     match, score = fuzzy_match_option(message, titles, threshold=70)
     
     if match:
         logger.info(f"Fuzzy match: '{message}' -> '{match}' (score: {score})")
-        for btn in buttons:
-            if btn.get("title") == match:
-                return btn.get("id")
+        return ids[titles.index(match)]
     
     return None
 
@@ -142,49 +230,39 @@ def _personalize_response(text, nickname=None):
     if not nickname:
         return text
     # Si el texto empieza con saludo, agregar nombre
-    greetings = ["hola", "bienvenido", "gracias"]
     text_lower = text.lower()
-    for greeting in greetings:
+    for greeting, capitalized in _GREETINGS:
         if text_lower.startswith(greeting):
-            return text.replace(greeting.capitalize(), f"{greeting.capitalize()} {nickname}", 1)
+            return text.replace(capitalized, f"{capitalized} {nickname}", 1)
     return text
 
 
 async def _go_to_flow(phone, flow_id, conversation, db, nickname=None):
     """Navegar a un flujo especifico"""
-    session.update_conversation_state(
-        conversation, 
-        conversation.state, 
-        db, 
-        {"current_flow": flow_id}
+    # Volver a mostrar el flujo actual no cambia nada en BD: evitar el UPDATE + COMMIT
+    if (conversation.context or {}).get("current_flow") == flow_id:
+        await _show_flow(phone, flow_id, nickname)
+        return
+
+    # El commit corre en un hilo mientras se envía el flujo
+    await _alongside_db(
+        _show_flow(phone, flow_id, nickname),
+        session.update_conversation_state, conversation, conversation.state, db, {"current_flow": flow_id},
     )
-    await _show_flow(phone, flow_id, nickname)
 
 
 async def _show_flow(phone, flow_id, nickname=None):
     """Mostrar un flujo (con botones o solo texto)"""
-    flow_data = flows_config.get("flows", {}).get(flow_id, {})
-    
-    if not flow_data:
-        flow_data = flows_config.get("flows", {}).get("welcome", {})
+    if not _FLOWS.get(flow_id):
         flow_id = "welcome"
     
-    # Obtener texto y reemplazar variables
-    business = business_config.get("business", {})
-    text = flow_data.get("text", "")
-    text = text.replace("{business_name}", business.get("name", "nuestra empresa"))
-    
-    # Personalizar con nickname
+    # Personalizar con nickname sobre la plantilla precalculada
     if nickname and flow_id == "welcome":
-        text = text.replace("Bienvenido", f"Hola {nickname}! Bienvenido")
-    
-    buttons = flow_data.get("buttons", [])
-    header = flow_data.get("header", "")
-    
-    if buttons:
-        await whatsapp.send_menu(phone, text, buttons, header)
+        text = _WELCOME_TEMPLATE.replace(_NICKNAME_SLOT, nickname)
     else:
-        await whatsapp.send_message(phone, text)
+        text = _FLOW_MESSAGES.get(flow_id, "")
+    
+    await whatsapp.send_message(phone, text)
 
 
 async def _handle_llm_support(phone, message, conversation, db, nickname=None):
@@ -200,23 +278,18 @@ async def _handle_llm_support(phone, message, conversation, db, nickname=None):
         topic_counts = context.get("topic_counts", {})
         interaction_count = topic_counts.get(topic, 0) + 1
         topic_counts[topic] = interaction_count
-        
-        # Guardar conteo
         context["topic_counts"] = topic_counts
-        session.update_conversation_state(conversation, conversation.state, db, context)
         
         # Obtener respuesta progresiva
         progressive_response = get_progressive_response(topic, interaction_count)
         if progressive_response:
             response = _personalize_response(progressive_response, nickname)
-            _save_message(conversation, "bot", response, None, db)
-            await whatsapp.send_message(phone, response)
+            # Conteo y mensaje del bot en un solo commit
+            _save_message(conversation, "bot", response, None, db, commit=False)
+            await _send_and_persist(phone, response, conversation, db, context)
             return
+        # Sin respuesta progresiva: el conteo se guarda junto al resto del contexto
 
-    # Analizar sentimiento
-    sentiment = analyze_sentiment(message)
-    empathetic_prefix = get_empathetic_prefix(sentiment)
-    
     # Extraer entidades (telefono, email, etc)
     entities = extract_entities(message)
     if entities:
@@ -225,31 +298,44 @@ async def _handle_llm_support(phone, message, conversation, db, nickname=None):
 
     # Verificar cache primero
     cached = get_cached_response(message)
+    is_error_reply = False
     if cached:
-        response = empathetic_prefix + cached if empathetic_prefix else cached
+        sentiment = analyze_sentiment(message)
+        response = cached
     else:
-        # Obtener respuesta de LLM
-        response = await llm.get_llm_response(message, history)
+        # Analizar sentimiento en un hilo mientras se espera al LLM
+        sentiment, response = await asyncio.gather(
+            asyncio.to_thread(analyze_sentiment, message),
+            llm.get_llm_response(message, history),
+        )
         
+        # Las respuestas fijas de error ya están en el código: ni cache ni registro
+        is_error_reply = response in llm.ERROR_REPLIES
+
         # Guardar en cache si no es muy especifica
-        if len(message.split()) <= 10:
+        if not is_error_reply and len(message.split()) <= 10:
             cache_response(message, response)
-        
-        # Agregar prefijo empatico si es necesario
-        if empathetic_prefix:
-            response = empathetic_prefix + response
+
+    # Agregar prefijo empatico si es necesario
+    empathetic_prefix = get_empathetic_prefix(sentiment)
+    if empathetic_prefix:
+        response = empathetic_prefix + response
 
     # 4. Language Mirroring: Ajustar longitud según input del usuario
     response = adjust_response_length(response, len(message))
 
-    _save_message(conversation, "bot", response, None, db)
+    if not is_error_reply:
+        _save_message(conversation, "bot", response, None, db, commit=False)
 
-    # Actualizar historial y contexto
-    history.append({"role": "user", "content": message})
-    history.append({"role": "assistant", "content": response})
+    # Actualizar historial y contexto (deque acotado: descarta lo viejo sin copiar la lista)
+    recent = deque(history, maxlen=CHAT_HISTORY_SIZE)
+    recent.extend((
+        {"role": "user", "content": message},
+        {"role": "assistant", "content": response},
+    ))
     
     new_context = {
-        "chat_history": history[-6:],
+        "chat_history": list(recent),
         "current_flow": context.get("current_flow", "support_lvl1"),
         "sentiment_history": context.get("sentiment_history", []) + [sentiment["polarity"]],
         "nickname": context.get("nickname"),
@@ -259,9 +345,7 @@ async def _handle_llm_support(phone, message, conversation, db, nickname=None):
     if entities:
         new_context["entities"] = {**context.get("entities", {}), **entities}
     
-    session.update_conversation_state(conversation, conversation.state, db, new_context)
-
-    await whatsapp.send_message(phone, response)
+    await _send_and_persist(phone, response, conversation, db, new_context)
     
     # Si necesita humano, notificar
     if sentiment.get("needs_human"):
@@ -269,17 +353,44 @@ async def _handle_llm_support(phone, message, conversation, db, nickname=None):
         # Aqui se podria escalar a un agente humano
 
 
-def _save_message(conversation, sender, content, external_id, db):
-    """Guardar mensaje en la base de datos"""
-    msg_id = external_id or f"bot_{int(datetime.utcnow().timestamp())}_{conversation.id[:8]}"
-    
-    msg = Message(
-        id=msg_id,
-        conversation_id=conversation.id,
-        sender=sender,
-        direction="inbound" if sender == "user" else "outbound",
-        message_type="text",
-        content=content,
+async def _send_and_persist(phone, response, conversation, db, context):
+    """Enviar la respuesta mientras se confirma el contexto en un hilo"""
+    await _alongside_db(
+        whatsapp.send_message(phone, response),
+        session.update_conversation_state, conversation, conversation.state, db, context,
     )
-    db.add(msg)
-    db.commit()
+
+
+async def _alongside_db(coro, db_func, *args):
+    """Ejecutar coro mientras db_func usa la sesión en un hilo; no salir hasta que el hilo termine"""
+    db_task = asyncio.ensure_future(asyncio.to_thread(db_func, *args))
+    try:
+        await coro
+    finally:
+        # La sesión no es thread-safe: aunque el envío falle o se cancele,
+        # nadie debe cerrarla ni reutilizarla mientras el hilo la usa
+        await asyncio.shield(db_task)
+
+
+def _save_message(conversation, sender, content, external_id, db, commit=True):
+    """Guardar mensaje en la base de datos (las respuestas del bot se encolan si hay worker)"""
+    # Nanosegundos: dos respuestas en el mismo segundo no colisionan en la clave primaria
+    msg_id = external_id or f"bot_{time.time_ns()}_{conversation.id[:8]}"
+    
+    row = {
+        "id": msg_id,
+        "conversation_id": conversation.id,
+        "sender": sender,
+        "direction": "inbound" if sender == "user" else "outbound",
+        "message_type": "text",
+        "content": content,
+        "created_at": datetime.utcnow(),
+    }
+
+    # Respuesta del bot: escritura diferida, no bloquea el envío
+    if sender == "bot" and message_log.enqueue(row):
+        return
+
+    db.add(Message(**row))
+    if commit:
+        db.commit()
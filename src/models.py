@@ -5,10 +5,11 @@ Modelos de base de datos y esquemas de respuesta
 from datetime import datetime
 from typing import Optional
 
-from sqlalchemy import Column, Integer, String, Boolean, DateTime, Text, JSON, ForeignKey
+from sqlalchemy import Column, Integer, String, Boolean, DateTime, Text, JSON, ForeignKey, Index
+from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.ext.mutable import MutableDict
 from sqlalchemy.orm import DeclarativeBase, relationship
-from pydantic import BaseModel
+from pydantic import BaseModel, ConfigDict
 
 
 class Base(DeclarativeBase):
@@ -21,6 +22,8 @@ class Base(DeclarativeBase):
 # =============================================================================
 
 class SupportTicketResponse(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+
     ticket_id: str
     issue_type: str
     status: str
@@ -29,19 +32,15 @@ class SupportTicketResponse(BaseModel):
     created_at: datetime
     resolved_at: Optional[datetime] = None
 
-    class Config:
-        from_attributes = True
-
 
 class UserResponse(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+
     id: int
     phone: str
     name: Optional[str] = None
     created_at: datetime
 
-    class Config:
-        from_attributes = True
-
 
 class TicketStats(BaseModel):
     total_tickets: int
@@ -87,11 +86,12 @@ class Conversation(Base):
 
     id = Column(String(100), primary_key=True)
     user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
-    phone = Column(String(20), index=True, nullable=False)
+    phone = Column(String(20), nullable=False)
     
-    status = Column(String(20), default="active", index=True)
+    status = Column(String(20), default="active")
     state = Column(String(50), default="idle")
-    context = Column(MutableDict.as_mutable(JSON), default={})
+    # JSONB en PostgreSQL (binario, sin reparsear en cada lectura); JSON en el resto
+    context = Column(MutableDict.as_mutable(JSON().with_variant(JSONB(), "postgresql")), default=dict)
     
     message_count = Column(Integer, default=0)
     last_activity = Column(DateTime, default=datetime.utcnow)
@@ -103,6 +103,12 @@ class Conversation(Base):
     user = relationship("User", back_populates="conversations")
     messages = relationship("Message", back_populates="conversation")
 
+    __table_args__ = (
+        # Conversación activa más reciente de un teléfono en una sola lectura del índice
+        # (también cubre las búsquedas solo por teléfono)
+        Index("ix_conversations_phone_status_activity", "phone", "status", "last_activity"),
+    )
+
 
 class Message(Base):
     __tablename__ = "messages"
@@ -119,6 +125,11 @@ class Message(Base):
 
     conversation = relationship("Conversation", back_populates="messages")
 
+    __table_args__ = (
+        # Mensajes de una conversación en orden de llegada
+        Index("ix_messages_conversation_created", "conversation_id", "created_at"),
+    )
+
 
 class SupportTicket(Base):
     __tablename__ = "support_tickets"
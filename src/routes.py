@@ -2,6 +2,7 @@
 Rutas de la API
 """
 
+import hmac
 from datetime import datetime, timedelta
 from typing import List, Optional
 
@@ -19,10 +20,18 @@ router = APIRouter()
 
 # Seguridad: API Key Header
 api_key_header = APIKeyHeader(name="X-API-Key", auto_error=False)
+_admin_api_key = ADMIN_API_KEY.encode()
+
 
 async def verify_api_key(api_key: str = Security(api_key_header)):
     """Verificar API Key para rutas administrativas"""
-    if api_key != ADMIN_API_KEY:
+    if not api_key:
+        raise HTTPException(
+            status_code=401,
+            detail="API Key requerida"
+        )
+    # Sin clave configurada no se acepta ninguna
+    if not _admin_api_key or not hmac.compare_digest(api_key.encode(), _admin_api_key):
         raise HTTPException(
             status_code=403,
             detail="Credenciales inválidas"
@@ -35,7 +44,7 @@ async def verify_api_key(api_key: str = Security(api_key_header)):
 # =============================================================================
 
 @router.get("/tickets", response_model=List[SupportTicketResponse], dependencies=[Depends(verify_api_key)])
-async def list_tickets(
+def list_tickets(
     status: Optional[str] = None,
     issue_type: Optional[str] = None,
     limit: int = Query(50, le=100),
@@ -54,7 +63,7 @@ async def list_tickets(
 
 
 @router.get("/tickets/{ticket_id}", response_model=SupportTicketResponse, dependencies=[Depends(verify_api_key)])
-async def get_ticket(ticket_id: str, db: Session = Depends(get_db)):
+def get_ticket(ticket_id: str, db: Session = Depends(get_db)):
     """Obtener ticket por ID"""
     ticket = db.query(SupportTicket).filter(SupportTicket.ticket_id == ticket_id).first()
 
@@ -65,21 +74,25 @@ async def get_ticket(ticket_id: str, db: Session = Depends(get_db)):
 
 
 @router.get("/tickets/stats/summary", response_model=TicketStats, dependencies=[Depends(verify_api_key)])
-async def get_ticket_stats(db: Session = Depends(get_db)):
+def get_ticket_stats(db: Session = Depends(get_db)):
     """Obtener estadísticas de tickets"""
     total = db.query(SupportTicket).count()
     open_count = db.query(SupportTicket).filter(SupportTicket.status == "open").count()
     in_progress = db.query(SupportTicket).filter(SupportTicket.status == "in_progress").count()
     resolved = db.query(SupportTicket).filter(SupportTicket.status.in_(["resolved", "closed"])).count()
 
-    # Calcular tiempo promedio de resolución
-    resolved_tickets = db.query(SupportTicket).filter(SupportTicket.resolved_at.isnot(None)).all()
+    # Calcular tiempo promedio de resolución (solo las dos fechas, sin cargar el ticket completo)
+    resolved_tickets = (
+        db.query(SupportTicket.created_at, SupportTicket.resolved_at)
+        .filter(SupportTicket.resolved_at.isnot(None))
+        .all()
+    )
 
     avg_hours = 0.0
     if resolved_tickets:
         total_hours = 0
-        for ticket in resolved_tickets:
-            diff = (ticket.resolved_at - ticket.created_at).total_seconds() / 3600
+        for created_at, resolved_at in resolved_tickets:
+            diff = (resolved_at - created_at).total_seconds() / 3600
             total_hours += diff
         avg_hours = total_hours / len(resolved_tickets)
 
@@ -97,14 +110,14 @@ async def get_ticket_stats(db: Session = Depends(get_db)):
 # =============================================================================
 
 @router.get("/users", response_model=List[UserResponse], dependencies=[Depends(verify_api_key)])
-async def list_users(limit: int = Query(50, le=100), db: Session = Depends(get_db)):
+def list_users(limit: int = Query(50, le=100), db: Session = Depends(get_db)):
     """Listar usuarios"""
     users = db.query(User).order_by(desc(User.created_at)).limit(limit).all()
     return users
 
 
 @router.get("/analytics/messages", response_model=MessageAnalytics, dependencies=[Depends(verify_api_key)])
-async def get_message_analytics(
+def get_message_analytics(
     days: int = Query(7, ge=1, le=30),
     db: Session = Depends(get_db)
 ):
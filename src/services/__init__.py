@@ -6,3 +6,5 @@ from . import whatsapp
 from . import session
 from . import llm
 from . import rag
+from . import message_log
+from . import idempotency
@@ -0,0 +1,36 @@
+"""
+Claves vistas recientemente (idempotencia en memoria del proceso)
+"""
+
+import time
+from collections import OrderedDict
+
+
+class RecentKeys:
+    """Claves vistas recientemente, con expiración y tamaño acotado"""
+
+    def __init__(self, ttl_seconds, max_size):
+        self.ttl_seconds = ttl_seconds
+        self.max_size = max_size
+        self._expires = OrderedDict()
+
+    def seen(self, key):
+        """Registrar la clave; True si ya se había visto dentro del TTL"""
+        now = time.monotonic()
+
+        # Las entradas se insertan en orden de expiración: descartar solo las vencidas
+        while self._expires:
+            expires = next(iter(self._expires.values()))
+            if expires > now:
+                break
+            self._expires.popitem(last=False)
+
+        if key in self._expires:
+            return True
+
+        # Solo una clave nueva desplaza a la más antigua
+        if len(self._expires) >= self.max_size:
+            self._expires.popitem(last=False)
+
+        self._expires[key] = now + self.ttl_seconds
+        return False
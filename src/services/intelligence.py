@@ -3,8 +3,8 @@ Inteligencia local del bot - funciones genéricas reutilizables
 """
 
 import re
-import hashlib
-from datetime import datetime, timedelta
+import time
+from collections import OrderedDict
 from rapidfuzz import fuzz, process
 from textblob import TextBlob
 
@@ -17,54 +17,49 @@ _business = business_config.get("business", {})
 _business_phone = _business.get("phone", "")
 
 
-_response_cache = {}
+# Cache LRU de respuestas del LLM (clave normalizada -> (respuesta, expira))
+_response_cache = OrderedDict()
 CACHE_TTL_HOURS = 24
 MAX_CACHE_SIZE = 500
+_CACHE_TTL_SECONDS = CACHE_TTL_HOURS * 3600
+
+_PUNCTUATION_RE = re.compile(r'[^\w\s]')
+_WHITESPACE_RE = re.compile(r'\s+')
 
 
 def get_cached_response(question):
     """Buscar respuesta en cache"""
     key = _make_cache_key(question)
-    
-    if key in _response_cache:
-        entry = _response_cache[key]
-        if datetime.utcnow() < entry["expires"]:
-            logger.info(f"Cache hit para: {question[:50]}...")
-            return entry["response"]
-        else:
-            del _response_cache[key]
-    
-    return None
+    entry = _response_cache.get(key)
+
+    if entry is None:
+        return None
+
+    response, expires = entry
+    if time.monotonic() >= expires:
+        del _response_cache[key]
+        return None
+
+    _response_cache.move_to_end(key)
+    logger.info(f"Cache hit para: {question[:50]}...")
+    return response
 
 
 def cache_response(question, response):
     """Guardar respuesta en cache"""
-    if len(_response_cache) >= MAX_CACHE_SIZE:
-        _cleanup_cache()
-    
     key = _make_cache_key(question)
-    _response_cache[key] = {
-        "response": response,
-        "expires": datetime.utcnow() + timedelta(hours=CACHE_TTL_HOURS),
-        "hits": 0
-    }
+    _response_cache[key] = (response, time.monotonic() + _CACHE_TTL_SECONDS)
+    _response_cache.move_to_end(key)
+
+    # Descartar las entradas usadas hace más tiempo
+    while len(_response_cache) > MAX_CACHE_SIZE:
+        _response_cache.popitem(last=False)
 
 
 def _make_cache_key(text):
     """Generar key normalizada para cache"""
-    normalized = text.lower().strip()
-    normalized = re.sub(r'[^\w\s]', '', normalized)
-    normalized = re.sub(r'\s+', ' ', normalized)
-    return hashlib.md5(normalized.encode()).hexdigest()
-
-
-def _cleanup_cache():
-    """Limpiar entradas expiradas o menos usadas"""
-    now = datetime.utcnow()
-    expired = [k for k, v in _response_cache.items() if now > v["expires"]]
-    for k in expired:
-        del _response_cache[k]
-
+    normalized = _PUNCTUATION_RE.sub('', text.lower().strip())
+    return _WHITESPACE_RE.sub(' ', normalized)
 
 
 def fuzzy_match_option(user_input, options, threshold=70):
@@ -76,38 +71,42 @@ def fuzzy_match_option(user_input, options, threshold=70):
     
     user_input = user_input.lower().strip()
     
-    # Buscar mejor coincidencia
+    # Buscar mejor coincidencia (rapidfuzz descarta temprano bajo el umbral)
     result = process.extractOne(
         user_input,
         [opt.lower() for opt in options],
-        scorer=fuzz.WRatio
+        scorer=fuzz.WRatio,
+        score_cutoff=threshold,
     )
     
-    if result and result[1] >= threshold:
-        # Retornar la opcion original (no lowercase)
-        original_idx = [opt.lower() for opt in options].index(result[0])
-        return options[original_idx], result[1]
+    if result:
+        # Retornar la opcion original (no lowercase) por indice
+        return options[result[2]], result[1]
     
     return None, 0
 
 
+# Typos comunes en español (constantes, se construyen una sola vez)
+_TYPO_CORRECTIONS = {
+    "soprte": "soporte",
+    "tecnco": "tecnico",
+    "facturacion": "facturacion",
+    "pago": "pago",
+    "interntet": "internet",
+    "coneccion": "conexion",
+    "router": "router",
+    "lentoo": "lento",
+    "rapdo": "rapido",
+    "ayda": "ayuda",
+    "problma": "problema",
+    "solucion": "solucion",
+}
+_TYPO_KEYS = list(_TYPO_CORRECTIONS)
+
+
 def correct_common_typos(text):
     """Corregir typos comunes en español"""
-    corrections = {
-        "soprte": "soporte",
-        "tecnco": "tecnico",
-        "facturacion": "facturacion",
-        "pago": "pago",
-        "interntet": "internet",
-        "coneccion": "conexion",
-        "router": "router",
-        "lentoo": "lento",
-        "rapdo": "rapido",
-        "ayda": "ayuda",
-        "problma": "problema",
-        "solucion": "solucion",
-    }
-    
+    corrections = _TYPO_CORRECTIONS
     words = text.lower().split()
     corrected = []
     
@@ -117,7 +116,7 @@ def correct_common_typos(text):
             corrected.append(corrections[word])
         else:
             # Fuzzy match contra correcciones conocidas
-            match, score = fuzzy_match_option(word, list(corrections.keys()), threshold=80)
+            match, score = fuzzy_match_option(word, _TYPO_KEYS, threshold=80)
             if match:
                 corrected.append(corrections[match])
             else:
@@ -135,19 +134,35 @@ for pattern, response in _raw_keywords.items():
         response = response.replace("{business_phone}", _business_phone)
     KEYWORD_RESPONSES[pattern] = response
 
+# Patrones compilados una sola vez al importar
+_KEYWORD_PATTERNS = [
+    (re.compile(pattern, re.IGNORECASE), pattern, response)
+    for pattern, response in KEYWORD_RESPONSES.items()
+]
+
 
 def check_keyword_trigger(message):
     """Verificar si el mensaje activa una respuesta automática"""
-    message_lower = message.lower().strip()
-
-    for pattern, response in KEYWORD_RESPONSES.items():
-        if re.search(pattern, message_lower, re.IGNORECASE):
+    # Los patrones se compilan con IGNORECASE: no hace falta pasar a minusculas
+    for regex, pattern, response in _KEYWORD_PATTERNS:
+        if regex.search(message):
             logger.info(f"Keyword trigger: {pattern}")
             return response  # None = ir a welcome
 
     return False
 
 
+# Palabras de frustracion en español
+FRUSTRATION_WORDS = (
+    "malisimo", "pesimo", "horrible", "terrible", "enojado",
+    "molesto", "furioso", "harto", "cansado", "ridiculo",
+    "estafa", "robo", "ladrones", "incompetentes", "inaceptable",
+    "demanda", "abogado", "reclamo", "queja", "denuncia",
+)
+# Una sola pasada por el texto en lugar de una busqueda por palabra
+_FRUSTRATION_RE = re.compile("|".join(map(re.escape, FRUSTRATION_WORDS)))
+
+
 def analyze_sentiment(text):
     """
     Analizar sentimiento del mensaje
@@ -157,15 +172,8 @@ def analyze_sentiment(text):
         polarity = blob.sentiment.polarity
         
         # Detectar palabras de frustracion en español
-        frustration_words = [
-            "malisimo", "pesimo", "horrible", "terrible", "enojado",
-            "molesto", "furioso", "harto", "cansado", "ridiculo",
-            "estafa", "robo", "ladrones", "incompetentes", "inaceptable",
-            "demanda", "abogado", "reclamo", "queja", "denuncia"
-        ]
-        
         text_lower = text.lower()
-        has_frustration = any(word in text_lower for word in frustration_words)
+        has_frustration = _FRUSTRATION_RE.search(text_lower) is not None
         
         # Detectar mayusculas excesivas (gritos)
         uppercase_ratio = sum(1 for c in text if c.isupper()) / max(len(text), 1)
@@ -205,6 +213,12 @@ def get_empathetic_prefix(sentiment):
     return ""
 
 
+# Patrones de entidades compilados una sola vez
+_PHONE_RE = re.compile(r'[\+]?[\d]{1,3}[-\s]?[\d]{3}[-\s]?[\d]{3}[-\s]?[\d]{4}')
+_EMAIL_RE = re.compile(r'[\w\.-]+@[\w\.-]+\.\w+')
+_ACCOUNT_RE = re.compile(r'\b[A-Z]{0,3}\d{6,12}\b')
+
+
 def extract_entities(text):
     """
     Extraer entidades del texto (telefono, email, fecha)
@@ -215,26 +229,32 @@ def extract_entities(text):
     entities = {}
     
     # Telefono (varios formatos)
-    phone_pattern = r'[\+]?[\d]{1,3}[-\s]?[\d]{3}[-\s]?[\d]{3}[-\s]?[\d]{4}'
-    phones = re.findall(phone_pattern, text)
-    if phones:
-        entities["phone"] = phones[0]
+    phone = _PHONE_RE.search(text)
+    if phone:
+        entities["phone"] = phone.group()
     
     # Email
-    email_pattern = r'[\w\.-]+@[\w\.-]+\.\w+'
-    emails = re.findall(email_pattern, text)
-    if emails:
-        entities["email"] = emails[0]
+    email = _EMAIL_RE.search(text)
+    if email:
+        entities["email"] = email.group()
     
     # Numeros de cuenta/contrato
-    account_pattern = r'\b[A-Z]{0,3}\d{6,12}\b'
-    accounts = re.findall(account_pattern, text)
-    if accounts:
-        entities["account"] = accounts[0]
+    account = _ACCOUNT_RE.search(text)
+    if account:
+        entities["account"] = account.group()
     
     return entities
 
 
+# Patrones de nickname compilados una sola vez
+_NICKNAME_PATTERNS = (
+    re.compile(r'\b(?:soy|me llamo|mi nombre es)\s+(?:el|la|ing\.|dr\.|lic\.)?\s*([A-ZÁÉÍÓÚÑ][a-záéíóúñ]+)', re.IGNORECASE),
+    re.compile(r'\b(?:soy|me llamo)\s+([A-ZÁÉÍÓÚÑ][a-záéíóúñ]+)', re.IGNORECASE),
+)
+_GREETING_NAME_RE = re.compile(r'^(?:hola|buenas?|buenos?\s+\w+),?\s+([A-ZÁÉÍÓÚÑ][a-záéíóúñ]+)', re.IGNORECASE)
+_NICKNAME_STOPWORDS = frozenset(['el', 'la', 'un', 'una', 'cliente', 'usuario', 'persona'])
+
+
 def extract_nickname(text):
     """
     Extraer nickname/nombre del mensaje del usuario
@@ -242,22 +262,16 @@ def extract_nickname(text):
     text = text.strip()
     
     # Patron 1: "soy [titulo] nombre" o "me llamo nombre"
-    patterns = [
-        r'\b(?:soy|me llamo|mi nombre es)\s+(?:el|la|ing\.|dr\.|lic\.)?\s*([A-ZÁÉÍÓÚÑ][a-záéíóúñ]+)',
-        r'\b(?:soy|me llamo)\s+([A-ZÁÉÍÓÚÑ][a-záéíóúñ]+)',
-    ]
-    
-    for pattern in patterns:
-        match = re.search(pattern, text, re.IGNORECASE)
+    for pattern in _NICKNAME_PATTERNS:
+        match = pattern.search(text)
         if match:
             name = match.group(1).strip()
             # Validar que no sea una palabra comun
-            common_words = ['el', 'la', 'un', 'una', 'cliente', 'usuario', 'persona']
-            if name.lower() not in common_words and len(name) >= 2:
+            if name.lower() not in _NICKNAME_STOPWORDS and len(name) >= 2:
                 return name.capitalize()
     
     # Patron 2: Saludo seguido de coma y nombre "buenas, Juan"
-    match = re.search(r'^(?:hola|buenas?|buenos?\s+\w+),?\s+([A-ZÁÉÍÓÚÑ][a-záéíóúñ]+)', text, re.IGNORECASE)
+    match = _GREETING_NAME_RE.search(text)
     if match:
         name = match.group(1).strip()
         if len(name) >= 2:
@@ -276,6 +290,13 @@ for topic, levels in _raw_progressive.items():
 # Patrones de detección de tema (configurables)
 TOPIC_PATTERNS = business_config.get("progressive_topics", {})
 
+# Una alternancia compilada por tema (conserva el orden de prioridad de temas)
+_TOPIC_MATCHERS = [
+    (topic, re.compile("|".join(re.escape(kw.lower()) for kw in keywords)))
+    for topic, keywords in TOPIC_PATTERNS.items()
+    if keywords
+]
+
 
 def get_progressive_response(topic, interaction_count):
     """Obtener respuesta según nivel de interacción (1=detallada, 3=breve)"""
@@ -292,8 +313,8 @@ def detect_topic_for_progressive(message):
     """Detectar tema del mensaje para respuestas progresivas"""
     message_lower = message.lower()
 
-    for topic, keywords in TOPIC_PATTERNS.items():
-        if any(kw in message_lower for kw in keywords):
+    for topic, matcher in _TOPIC_MATCHERS:
+        if matcher.search(message_lower):
             return topic
 
     return None
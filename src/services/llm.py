@@ -2,15 +2,59 @@
 Servicio de LLM (Groq) y NLP
 """
 
+import asyncio
 import re
+
 import httpx
+import orjson
 
 from ..settings import GROQ_API_KEY, GROQ_MODEL, business_config, flows_config, get_logger
 
 logger = get_logger(__name__)
 
-# Cargar patrones de intents
+GROQ_API_URL = "https://api.groq.com/openai/v1/chat/completions"
+
+# Cliente HTTP compartido (una conexión HTTP/2 multiplexada con Groq)
+_client = None
+
+
+def _get_client():
+    """Obtener cliente HTTP compartido"""
+    global _client
+    if _client is None:
+        _client = httpx.AsyncClient(
+            headers={
+                "Authorization": f"Bearer {GROQ_API_KEY}",
+                "Content-Type": "application/json",
+            },
+            timeout=30.0,
+            limits=httpx.Limits(max_keepalive_connections=32, max_connections=64),
+            http2=True,
+        )
+    return _client
+
+
+async def close():
+    """Cerrar cliente HTTP compartido"""
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+# Respuestas fijas de error (no se registran ni se cachean como respuestas del LLM)
+_NOT_CONFIGURED_REPLY = "Lo siento, el servicio de IA no está configurado."
+_API_ERROR_REPLY = "Lo siento, tuve un problema al procesar su solicitud."
+_TECHNICAL_ERROR_REPLY = "Lo siento, ocurrió un error técnico. Por favor intente de nuevo."
+ERROR_REPLIES = frozenset((_NOT_CONFIGURED_REPLY, _API_ERROR_REPLY, _TECHNICAL_ERROR_REPLY))
+
+# Cargar patrones de intents (una regex compilada por intent, en el orden de configuración)
 _intent_patterns = flows_config.get("intents", {}).get("patterns", {})
+_INTENT_REGEXES = tuple(
+    (intent, re.compile("|".join(f"(?:{p})" for p in patterns)))
+    for intent, patterns in _intent_patterns.items()
+    if patterns
+)
 
 # System prompt configurable desde settings.json
 _business_name = business_config.get("business", {}).get("name", "Soporte")
@@ -31,10 +75,9 @@ def classify_intent(message):
     """Clasificar intención del mensaje usando patrones regex"""
     msg = message.lower().strip()
 
-    for intent, patterns in _intent_patterns.items():
-        for pattern in patterns:
-            if re.search(pattern, msg):
-                return intent
+    for intent, regex in _INTENT_REGEXES:
+        if regex.search(msg):
+            return intent
 
     return "unknown"
 
@@ -42,48 +85,42 @@ def classify_intent(message):
 async def get_llm_response(query, chat_history=None):
     """Obtener respuesta del LLM con contexto RAG"""
     if not GROQ_API_KEY:
-        return "Lo siento, el servicio de IA no está configurado."
+        return _NOT_CONFIGURED_REPLY
 
     # Importar RAG aquí para evitar import circular
     from .rag import get_context_for_query
     
-    # Obtener contexto
-    context = get_context_for_query(query)
+    # Obtener contexto en un hilo: la búsqueda (o la carga del índice si aún no
+    # terminó el precalentamiento) no bloquea el event loop
+    context = await asyncio.to_thread(get_context_for_query, query)
     
-    # Construir mensajes
-    system_prompt = SYSTEM_PROMPT.format(context=context)
-    messages = [{"role": "system", "content": system_prompt}]
-
-    if chat_history:
-        messages.extend(chat_history[-4:])
-
-    messages.append({"role": "user", "content": query})
+    # Construir mensajes (el system prompt incluye el contexto RAG de la consulta)
+    messages = [
+        {"role": "system", "content": SYSTEM_PROMPT.format(context=context)},
+        *(chat_history[-4:] if chat_history else ()),
+        {"role": "user", "content": query},
+    ]
 
     # Llamar a Groq
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                "https://api.groq.com/openai/v1/chat/completions",
-                headers={
-                    "Authorization": f"Bearer {GROQ_API_KEY}",
-                    "Content-Type": "application/json",
-                },
-                json={
-                    "model": GROQ_MODEL,
-                    "messages": messages,
-                    "temperature": 0.5,
-                    "max_tokens": 350,
-                },
-                timeout=30.0,
-            )
-
-            if response.status_code == 200:
-                data = response.json()
-                return data["choices"][0]["message"]["content"]
-            else:
-                logger.error(f"Error de Groq API: {response.status_code}")
-                return "Lo siento, tuve un problema al procesar su solicitud."
+        # Headers fijos en el cliente; el cuerpo se serializa con orjson
+        response = await _get_client().post(
+            GROQ_API_URL,
+            content=orjson.dumps({
+                "model": GROQ_MODEL,
+                "messages": messages,
+                "temperature": 0.5,
+                "max_tokens": 350,
+            }),
+        )
+
+        if response.status_code == 200:
+            data = orjson.loads(response.content)
+            return data["choices"][0]["message"]["content"]
+        else:
+            logger.error(f"Error de Groq API: {response.status_code}")
+            return _API_ERROR_REPLY
 
     except Exception as e:
         logger.error(f"Error en LLM: {e}")
-        return "Lo siento, ocurrió un error técnico. Por favor intente de nuevo."
+        return _TECHNICAL_ERROR_REPLY
@@ -0,0 +1,126 @@
+"""
+Registro diferido de mensajes del bot (cola + worker en background)
+"""
+
+import asyncio
+
+from sqlalchemy import insert
+
+from ..db import get_db_session
+from ..models import Message
+from ..settings import get_logger
+
+logger = get_logger(__name__)
+
+QUEUE_MAX_SIZE = 10000
+BATCH_SIZE = 64
+BATCH_WINDOW_SECONDS = 0.1
+STOP_TIMEOUT_SECONDS = 10
+
+_queue = None
+_worker = None
+
+
+def _write_batch(rows):
+    """Insertar un lote de mensajes con un solo commit (INSERT de Core, sin unit of work del ORM)"""
+    db = None
+    try:
+        db = get_db_session()
+        db.execute(insert(Message.__table__), rows)
+        db.commit()
+    except Exception as e:
+        if db is None:
+            logger.error(f"Sin sesión de BD, {len(rows)} mensajes sin guardar: {e}")
+            return
+        db.rollback()
+        logger.warning(f"Error guardando lote de {len(rows)} mensajes, reintentando uno por uno: {e}")
+        _write_rows(db, rows)
+    finally:
+        if db is not None:
+            db.close()
+
+
+def _write_rows(db, rows):
+    """Insertar cada mensaje por separado: una fila inválida no arrastra al resto"""
+    for row in rows:
+        try:
+            db.execute(insert(Message.__table__), row)
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            logger.error(f"Error guardando mensaje {row.get('id')}: {e}")
+
+
+async def _collect_batch():
+    """Esperar el primer mensaje y juntar hasta BATCH_SIZE dentro de la ventana"""
+    loop = asyncio.get_running_loop()
+    rows = [await _queue.get()]
+    deadline = loop.time() + BATCH_WINDOW_SECONDS
+
+    while len(rows) < BATCH_SIZE:
+        if not _queue.empty():
+            rows.append(_queue.get_nowait())
+            continue
+        timeout = deadline - loop.time()
+        if timeout <= 0:
+            break
+        try:
+            rows.append(await asyncio.wait_for(_queue.get(), timeout))
+        except asyncio.TimeoutError:
+            break
+
+    return rows
+
+
+async def _run():
+    """Vaciar la cola por lotes fuera del event loop"""
+    while True:
+        rows = await _collect_batch()
+
+        try:
+            await asyncio.to_thread(_write_batch, rows)
+        except Exception as e:
+            # Un lote fallido no debe detener el worker
+            logger.error(f"Error en el worker de mensajes, {len(rows)} mensajes sin guardar: {e}")
+        finally:
+            for _ in rows:
+                _queue.task_done()
+
+
+def start():
+    """Iniciar el worker (llamar dentro del event loop)"""
+    global _queue, _worker
+    _queue = asyncio.Queue(maxsize=QUEUE_MAX_SIZE)
+    _worker = asyncio.create_task(_run())
+
+
+async def stop():
+    """Guardar lo pendiente y detener el worker"""
+    global _queue, _worker
+    if _worker is None:
+        return
+
+    # Si el worker ya terminó nadie vaciará la cola: no esperar
+    if not _worker.done():
+        try:
+            await asyncio.wait_for(_queue.join(), STOP_TIMEOUT_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+
+    pending = _queue.qsize()
+    if pending:
+        logger.warning(f"{pending} mensajes sin guardar al detener el registro")
+    _worker.cancel()
+    _queue, _worker = None, None
+
+
+def enqueue(row):
+    """Encolar un mensaje; False si no hay worker o la cola está llena"""
+    if _worker is None or _worker.done():
+        return False
+    try:
+        _queue.put_nowait(row)
+        return True
+    except asyncio.QueueFull:
+        logger.warning("Cola de mensajes llena, guardando de forma síncrona")
+        return False
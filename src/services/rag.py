@@ -4,9 +4,10 @@ Servicio RAG - Búsqueda BM25
 
 import os
 import pickle
+import hashlib
+import threading
+from functools import lru_cache
 
-from langchain_text_splitters import RecursiveCharacterTextSplitter
-from langchain_community.document_loaders import PyPDFLoader, TextLoader, Docx2txtLoader
 from rank_bm25 import BM25Okapi
 
 from ..settings import get_logger
@@ -17,15 +18,37 @@ logger = get_logger(__name__)
 DOCS_PATH = "docs"
 INDEX_PATH = "data/vector_store/index_bm25.pkl"
 
-# Variables globales para el índice
-_bm25 = None
-_chunks = []
+# Índice publicado como una sola tupla (BM25Okapi, chunks): quien busca
+# nunca ve el BM25 de un índice con los chunks de otro
+_index = None
 
+# Carga/reconstrucción de a un hilo (precalentamiento y primeras búsquedas)
+_index_lock = threading.RLock()
+
+
+def _docs_fingerprint():
+    """Huella de la carpeta docs (ruta, tamaño y fecha de modificación)"""
+    digest = hashlib.blake2b(digest_size=16)
+
+    for root, dirs, files in os.walk(DOCS_PATH):
+        dirs.sort()
+        for filename in sorted(files):
+            if filename.startswith("."):
+                continue
+            filepath = os.path.join(root, filename)
+            stat = os.stat(filepath)
+            digest.update(
+                f"{os.path.relpath(filepath, DOCS_PATH)}|{stat.st_size}|{stat.st_mtime_ns}\n".encode()
+            )
+
+    return digest.hexdigest()
+
+
+def _iter_documents():
+    """Recorrer los documentos de la carpeta docs (generador)"""
+    # langchain solo se necesita al reconstruir el índice
+    from langchain_community.document_loaders import PyPDFLoader, TextLoader, Docx2txtLoader
 
-def _load_documents():
-    """Cargar todos los documentos de la carpeta docs"""
-    documents = []
-    
     loaders = {
         ".pdf": PyPDFLoader,
         ".txt": TextLoader,
@@ -34,7 +57,7 @@ def _load_documents():
     }
 
     if not os.path.exists(DOCS_PATH):
-        return documents
+        return
 
     for root, dirs, files in os.walk(DOCS_PATH):
         for filename in files:
@@ -50,57 +73,75 @@ def _load_documents():
 
             try:
                 loader = loader_class(filepath)
-                docs = loader.load()
-                
-                for doc in docs:
-                    doc.metadata["source"] = os.path.relpath(filepath, DOCS_PATH)
-                
-                documents.extend(docs)
+                source = os.path.relpath(filepath, DOCS_PATH)
+
+                for doc in loader.lazy_load():
+                    doc.metadata["source"] = source
+                    yield doc
+
                 logger.info(f"Documento cargado: {filepath}")
             except Exception as e:
                 logger.error(f"Error cargando {filepath}: {e}")
 
-    return documents
-
 
 def rebuild_index():
     """Reconstruir índice BM25"""
-    global _bm25, _chunks
+    with _index_lock:
+        _rebuild_index()
+
+
+def _rebuild_index():
+    """Construir, publicar y guardar el índice (con el lock tomado)"""
+    global _index
     
+    from langchain_text_splitters import RecursiveCharacterTextSplitter
+
     logger.info("Reconstruyendo índice BM25...")
-    
-    documents = _load_documents()
-    if not documents:
+    fingerprint = _docs_fingerprint()
+
+    # Dividir en chunks a medida que se leen los documentos
+    splitter = RecursiveCharacterTextSplitter(chunk_size=700, chunk_overlap=100)
+    chunks = splitter.split_documents(_iter_documents())
+    if not chunks:
         logger.warning("No se encontraron documentos")
         return
 
-    # Dividir en chunks
-    splitter = RecursiveCharacterTextSplitter(chunk_size=700, chunk_overlap=100)
-    _chunks = splitter.split_documents(documents)
-    
-    # Crear índice BM25
-    tokenized_corpus = [doc.page_content.lower().split() for doc in _chunks]
-    _bm25 = BM25Okapi(tokenized_corpus)
+    # Crear índice BM25 completo antes de publicarlo
+    tokenized_corpus = [doc.page_content.lower().split() for doc in chunks]
+    bm25 = BM25Okapi(tokenized_corpus)
 
-    # Guardar índice
+    _index = (bm25, chunks)
+    _search_tokens.cache_clear()
+
+    # Guardar índice: archivo temporal + reemplazo atómico, otro worker
+    # nunca lee un pickle a medio escribir
     os.makedirs(os.path.dirname(INDEX_PATH), exist_ok=True)
-    with open(INDEX_PATH, "wb") as f:
-        pickle.dump({"bm25": _bm25, "chunks": _chunks}, f)
+    tmp_path = f"{INDEX_PATH}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        pickle.dump({"bm25": bm25, "chunks": chunks, "fingerprint": fingerprint}, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, INDEX_PATH)
 
-    logger.info(f"Índice creado con {len(_chunks)} chunks")
+    logger.info(f"Índice creado con {len(chunks)} chunks")
 
 
 def _load_index():
     """Cargar índice existente o crear uno nuevo"""
-    global _bm25, _chunks
+    global _index
     
     try:
         if os.path.exists(INDEX_PATH):
             with open(INDEX_PATH, "rb") as f:
                 data = pickle.load(f)
-                _bm25 = data["bm25"]
-                _chunks = data["chunks"]
-            logger.info(f"Índice cargado con {len(_chunks)} chunks")
+
+            # Reconstruir solo si los documentos cambiaron
+            if data.get("fingerprint") != _docs_fingerprint():
+                logger.info("Documentos modificados desde el último índice")
+                rebuild_index()
+                return
+
+            _index = (data["bm25"], data["chunks"])
+            _search_tokens.cache_clear()
+            logger.info(f"Índice cargado con {len(data['chunks'])} chunks")
         else:
             rebuild_index()
     except Exception as e:
@@ -108,27 +149,41 @@ def _load_index():
         rebuild_index()
 
 
+def _ensure_index():
+    """Cargar el índice una sola vez aunque varios hilos busquen a la vez"""
+    with _index_lock:
+        # Otro hilo pudo cargarlo mientras se esperaba el lock
+        if _index is None:
+            _load_index()
+
+
+@lru_cache(maxsize=256)
+def _search_tokens(tokens, k):
+    """Buscar en el índice BM25 (cacheado por tokens de la consulta)"""
+    bm25, chunks = _index
+    top_docs = bm25.get_top_n(list(tokens), chunks, n=k)
+    return tuple(
+        (doc.page_content, doc.metadata.get("source", "unknown"))
+        for doc in top_docs
+    )
+
+
 def search(query, k=3):
     """Buscar documentos relevantes"""
-    global _bm25, _chunks
-    
-    if _bm25 is None:
-        _load_index()
+    if _index is None:
+        _ensure_index()
     
-    if not _bm25 or not _chunks:
+    if _index is None or not _index[1]:
         return []
 
     try:
-        tokenized_query = query.lower().split()
-        top_docs = _bm25.get_top_n(tokenized_query, _chunks, n=k)
-
-        results = []
-        for doc in top_docs:
-            results.append({
-                "content": doc.page_content,
-                "source": doc.metadata.get("source", "unknown"),
-            })
-        return results
+        # BM25 ignora el orden de los tokens: consultas con las mismas
+        # palabras en distinto orden comparten entrada de cache
+        tokens = tuple(sorted(query.lower().split()))
+        return [
+            {"content": content, "source": source}
+            for content, source in _search_tokens(tokens, k)
+        ]
     except Exception as e:
         logger.error(f"Error en búsqueda: {e}")
         return []
@@ -146,7 +201,3 @@ def get_context_for_query(query, k=3):
         parts.append(f"[Ref: {doc['source']}]\n{doc['content']}")
     
     return "\n\n".join(parts)
-
-
-# Cargar índice al importar
-_load_index()
@@ -2,60 +2,182 @@
 Servicio de sesiones y usuarios
 """
 
+import threading
+import time
 import uuid
+from collections import OrderedDict
 from datetime import datetime, timedelta
 
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
 from ..models import Conversation, User
 
 
-def get_or_create_user(phone, db):
+# Caches en proceso (LRU acotado): teléfono -> (id de usuario, último registro de actividad)
+# y teléfono -> id de su conversación activa
+ID_CACHE_SIZE = 10000
+_user_ids = OrderedDict()
+_conversation_ids = OrderedDict()
+
+# Las caches se modifican desde los hilos de asyncio.to_thread
+_cache_lock = threading.Lock()
+
+# Ids pendientes de una transacción sin confirmar (en Session.info)
+_PENDING_KEY = "pending_cached_ids"
+
+# last_seen se escribe como máximo una vez por ventana y usuario
+LAST_SEEN_RESOLUTION_SECONDS = 60
+
+
+def _remember(cache, phone, obj_id):
+    """Guardar un valor en la cache LRU del teléfono"""
+    with _cache_lock:
+        cache[phone] = obj_id
+        cache.move_to_end(phone)
+        while len(cache) > ID_CACHE_SIZE:
+            cache.popitem(last=False)
+
+
+def _remember_committed(db, cache, phone, obj_id, committed):
+    """Cachear solo ids confirmados: si aún no hay commit, esperar al de quien llamó"""
+    if committed:
+        _remember(cache, phone, obj_id)
+    else:
+        db.info.setdefault(_PENDING_KEY, []).append((cache, phone, obj_id))
+
+
+@event.listens_for(Session, "after_commit")
+def _apply_pending(db):
+    """Cachear los ids de la transacción recién confirmada"""
+    for cache, phone, obj_id in db.info.pop(_PENDING_KEY, ()):
+        _remember(cache, phone, obj_id)
+
+
+@event.listens_for(Session, "after_transaction_end")
+def _discard_pending(db, transaction):
+    """Descartar ids de una transacción revertida (tras un commit ya no queda nada)"""
+    if transaction.parent is None:
+        db.info.pop(_PENDING_KEY, None)
+
+
+def _lookup(cache, phone):
+    """Leer un valor de la cache y marcarlo como usado (None si no está)"""
+    with _cache_lock:
+        value = cache.get(phone)
+        if value is not None:
+            cache.move_to_end(phone)
+    return value
+
+
+def _forget(cache, phone):
+    """Descartar un valor de la cache"""
+    with _cache_lock:
+        cache.pop(phone, None)
+
+
+def _cached_user(phone, db):
+    """Obtener el usuario cacheado por clave primaria"""
+    entry = _lookup(_user_ids, phone)
+    if entry is None:
+        return None
+
+    user = db.get(User, entry[0])
+    if user is None or user.phone != phone:
+        _forget(_user_ids, phone)
+        return None
+
+    return user
+
+
+def _cached_conversation(phone, db):
+    """Obtener la conversación activa cacheada por clave primaria"""
+    conv_id = _lookup(_conversation_ids, phone)
+    if conv_id is None:
+        return None
+
+    # Validar contra la BD: pudo cerrarse o crearse en otro worker
+    conversation = db.get(Conversation, conv_id)
+    if conversation is None or conversation.status not in ("active", "idle"):
+        _forget(_conversation_ids, phone)
+        return None
+
+    return conversation
+
+
+def _persist(db, commit):
+    """Confirmar la transacción o solo enviar los cambios pendientes"""
+    if commit:
+        db.commit()
+    else:
+        db.flush()
+
+
+def get_or_create_user(phone, db, commit=True):
     """Obtener usuario existente o crear uno nuevo"""
-    user = db.query(User).filter(User.phone == phone).first()
+    user = _cached_user(phone, db) or db.query(User).filter(User.phone == phone).first()
     is_new = False
+    now = datetime.utcnow()
 
     if not user:
         user = User(
             phone=phone,
-            first_seen=datetime.utcnow(),
-            last_seen=datetime.utcnow(),
+            first_seen=now,
+            last_seen=now,
             total_conversations=0,
         )
         db.add(user)
-        db.commit()
-        db.refresh(user)
         is_new = True
     else:
-        user.last_seen = datetime.utcnow()
-        db.commit()
+        user.last_seen = now
 
+    _persist(db, commit)
+    _remember_committed(db, _user_ids, phone, (user.id, time.monotonic()), commit)
     return user, is_new
 
 
-def get_or_create_conversation(phone, db):
-    """Obtener conversación activa o crear una nueva"""
-    conversation = (
-        db.query(Conversation)
-        .filter(
-            Conversation.phone == phone,
-            Conversation.status.in_(["active", "idle"]),
+def touch_user(phone, db, commit=True):
+    """Registrar actividad del usuario y devolver su id (sin consultas si se vio hace poco)"""
+    entry = _lookup(_user_ids, phone)
+    if entry and time.monotonic() - entry[1] < LAST_SEEN_RESOLUTION_SECONDS:
+        return entry[0]
+
+    user, _ = get_or_create_user(phone, db, commit)
+    return user.id
+
+
+def get_or_create_conversation(phone, db, commit=True, user_id=None):
+    """Obtener conversación activa o crear una nueva (user_id evita buscar al usuario por teléfono)"""
+    conversation = _cached_conversation(phone, db)
+    if conversation is None:
+        conversation = (
+            db.query(Conversation)
+            .filter(
+                Conversation.phone == phone,
+                Conversation.status.in_(["active", "idle"]),
+            )
+            .order_by(Conversation.last_activity.desc())
+            .first()
         )
-        .order_by(Conversation.last_activity.desc())
-        .first()
-    )
+
+    now = datetime.utcnow()
 
     # Cerrar si expiró el TTL
     if conversation and conversation.ttl_expires_at:
-        if datetime.utcnow() > conversation.ttl_expires_at:
+        if now > conversation.ttl_expires_at:
             conversation.status = "closed"
-            db.commit()
             conversation = None
 
     # Crear nueva si no existe
     if not conversation:
-        user = db.query(User).filter(User.phone == phone).first()
+        user = db.get(User, user_id) if user_id is not None else None
+        if user is not None and user.phone != phone:
+            user = None
+        if user is None:
+            user = _cached_user(phone, db) or db.query(User).filter(User.phone == phone).first()
 
         conv_id = (
-            f"{phone.replace('+', '')}_{datetime.utcnow().strftime('%Y%m%d%H%M%S')}"
+            f"{phone.replace('+', '')}_{now:%Y%m%d%H%M%S}"
             f"_{uuid.uuid4().hex[:6]}"
         )
 
@@ -65,26 +187,24 @@ def get_or_create_conversation(phone, db):
             phone=phone,
             status="active",
             state="idle",
-            ttl_expires_at=datetime.utcnow() + timedelta(hours=24),
+            ttl_expires_at=now + timedelta(hours=24),
         )
         db.add(conversation)
 
         if user:
             user.total_conversations += 1
 
-        db.commit()
-        db.refresh(conversation)
-
     # Actualizar actividad
-    conversation.last_activity = datetime.utcnow()
+    conversation.last_activity = now
     if conversation.status == "idle":
         conversation.status = "active"
-    db.commit()
 
+    _persist(db, commit)
+    _remember_committed(db, _conversation_ids, phone, conversation.id, commit)
     return conversation
 
 
-def update_conversation_state(conversation, state, db, context=None):
+def update_conversation_state(conversation, state, db, context=None, commit=True):
     """Actualizar estado y contexto de la conversación"""
     conversation.state = state
 
@@ -93,5 +213,4 @@ def update_conversation_state(conversation, state, db, context=None):
         current_context.update(context)
         conversation.context = current_context
 
-    db.commit()
-    db.refresh(conversation)
+    _persist(db, commit)
@@ -4,6 +4,7 @@ Servicio de WhatsApp (Twilio)
 
 import httpx
 from base64 import b64encode
+from tenacity import retry, stop_after_attempt, wait_exponential
 
 from ..settings import TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN, TWILIO_PHONE_NUMBER, get_logger
 
@@ -22,9 +23,29 @@ if TWILIO_ACCOUNT_SID:
         "Authorization": f"Basic {b64encode(auth_string.encode()).decode()}",
         "Content-Type": "application/x-www-form-urlencoded",
     }
-from tenacity import retry, stop_after_attempt, wait_exponential, retry_if_exception_type
 
-# ... (imports)
+# Cliente HTTP compartido (reutiliza conexiones TCP/TLS con Twilio)
+_client = None
+
+
+def _get_client():
+    """Obtener cliente HTTP compartido"""
+    global _client
+    if _client is None:
+        _client = httpx.AsyncClient(
+            timeout=30.0,
+            limits=httpx.Limits(max_keepalive_connections=5, max_connections=10),
+        )
+    return _client
+
+
+async def close():
+    """Cerrar cliente HTTP compartido"""
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
 
 @retry(
     stop=stop_after_attempt(3),
@@ -49,31 +70,26 @@ async def send_message(to, message):
         "Body": message,
     }
 
-    async with httpx.AsyncClient() as client:
-        response = await client.post(
-            f"{_base_url}/Messages.json",
-            data=payload,
-            headers=_headers,
-            timeout=30.0,
-        )
-        
-        # Raise for status code >= 400
-        response.raise_for_status()
-        
-        return response.json()
+    response = await _get_client().post(
+        f"{_base_url}/Messages.json",
+        data=payload,
+        headers=_headers,
+    )
 
+    # Raise for status code >= 400
+    response.raise_for_status()
 
-async def send_menu(to, body, buttons, header=None):
-    """Enviar menu con opciones numeradas"""
-    msg = ""
-    if header:
-        msg = f"*{header}*\n\n"
-    msg += f"{body}\n\n"
+    return response.json()
 
-    for i, btn in enumerate(buttons[:10], 1):
-        title = btn.get("title", "")
-        msg += f"*{i}.* {title}\n"
 
-    msg += "\n_Responda con el numero de su opcion_"
-    
-    return await send_message(to, msg)
+def format_menu(body, buttons, header=None):
+    """Construir el texto de un menu con opciones numeradas"""
+    parts = [f"*{header}*\n\n" if header else "", f"{body}\n\n"]
+    parts.extend(f"*{i}.* {btn.get('title', '')}\n" for i, btn in enumerate(buttons[:10], 1))
+    parts.append("\n_Responda con el numero de su opcion_")
+    return "".join(parts)
+
+
+async def send_menu(to, body, buttons, header=None):
+    """Enviar menu con opciones numeradas"""
+    return await send_message(to, format_menu(body, buttons, header))
@@ -4,12 +4,15 @@ Configuración de la aplicación
 
 import os
 import re
-import json
+import queue
+import atexit
 import logging
 import logging.handlers
 import hashlib
 from datetime import datetime
 
+import orjson
+
 # Cargar variables de entorno desde .env si existe
 from dotenv import load_dotenv
 load_dotenv()
@@ -32,10 +35,19 @@ LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
 
 # Database
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./data/chatbot.db")
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "25"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "50"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+DB_POOL_TIMEOUT = int(os.getenv("DB_POOL_TIMEOUT", "10"))
+DB_STATEMENT_TIMEOUT_MS = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", "15000"))
 
 # API
 API_HOST = os.getenv("API_HOST", "0.0.0.0")
 API_PORT = int(os.getenv("API_PORT", "8000"))
+API_BACKLOG = int(os.getenv("API_BACKLOG", "4096"))
+API_WORKERS = int(os.getenv("WEB_CONCURRENCY", str(max(2, os.cpu_count() or 1))))
+MAX_INFLIGHT = int(os.getenv("MAX_INFLIGHT", "256"))
+DUPLICATE_WINDOW_SECONDS = float(os.getenv("DUPLICATE_WINDOW_SECONDS", "5"))
 
 # LLM
 GROQ_API_KEY = os.getenv("GROQ_API_KEY", "")
@@ -63,7 +75,18 @@ _file_handler = logging.handlers.RotatingFileHandler(
 _file_handler.setLevel(_log_level)
 _file_handler.setFormatter(logging.Formatter(_log_format))
 
-logging.basicConfig(level=_log_level, handlers=[_console_handler, _file_handler])
+# Escritura de logs en un hilo aparte para no bloquear el event loop
+_log_queue = queue.SimpleQueue()
+_log_listener = logging.handlers.QueueListener(
+    _log_queue, _console_handler, _file_handler, respect_handler_level=True
+)
+_log_listener.start()
+atexit.register(_log_listener.stop)
+
+_queue_handler = logging.handlers.QueueHandler(_log_queue)
+_queue_handler.setFormatter(logging.Formatter("%(message)s"))
+
+logging.basicConfig(level=_log_level, handlers=[_queue_handler])
 
 
 def get_logger(name):
@@ -80,8 +103,8 @@ def load_json_config(filename, default):
     config_path = os.path.join(os.path.dirname(__file__), "..", "config", filename)
     
     if os.path.exists(config_path):
-        with open(config_path, "r", encoding="utf-8") as f:
-            return json.load(f)
+        with open(config_path, "rb") as f:
+            return orjson.loads(f.read())
     return default
 
 
@@ -128,3 +151,4 @@ def sanitize_input(text):
     text = re.sub(r"\s+", " ", text).strip()
     text = re.sub(r"[<>{}]", "", text)
     return text
+